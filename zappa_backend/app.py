@@ -1,12 +1,27 @@
 import os
+import logging
+import secrets
+import orjson
 from flask import Flask, request, jsonify, session
-from flask_cors import CORS
+from flask.json.provider import DefaultJSONProvider
 from llm_prompter import LLMPrompter
 from conversation_state import ConversationState
+from session_store import create_session_store
 import json
-from uuid import uuid4
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG if os.environ.get('DEBUG') else logging.INFO)
+
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider backed by orjson for request bodies, responses and the session cookie"""
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 app.secret_key = os.environ.get('SECRET_KEY', 'your-secret-key-change-this-in-production')
 is_local_dev = os.environ.get('AWS_LAMBDA_FUNCTION_NAME') is None
 
@@ -17,54 +32,69 @@ app.config['SESSION_COOKIE_HTTPONLY'] = True
 app.config['SESSION_COOKIE_NAME'] = 'language_chat_session'
 app.config['PERMANENT_SESSION_LIFETIME'] = 60 * 60 * 24 * 7
 
-CORS(
-    app,
-    supports_credentials=True,
-    origins="*",
-    allow_headers=[
-        'Content-Type',
-        'Authorization',
-        'X-Requested-With',
-    ],
-    expose_headers=[
-        'Set-Cookie',
-    ]
-)
+session_store = create_session_store(ttl_seconds=app.config['PERMANENT_SESSION_LIFETIME'])
+
+# CORS: any origin, with credentials (so the request Origin is echoed back instead of '*')
+CORS_ALLOW_HEADERS = ', '.join(('Content-Type', 'Authorization', 'X-Requested-With'))
+CORS_ALLOW_METHODS = ', '.join(('GET', 'HEAD', 'OPTIONS', 'POST'))
+CORS_EXPOSE_HEADERS = 'Set-Cookie'
+
+@app.after_request
+def add_cors_headers(response):
+    origin = request.headers.get('Origin')
+    if not origin:
+        return response
+    headers = response.headers
+    headers['Access-Control-Allow-Origin'] = origin
+    headers['Access-Control-Allow-Credentials'] = 'true'
+    headers.add('Vary', 'Origin')
+    if request.method == 'OPTIONS':
+        headers['Access-Control-Allow-Methods'] = CORS_ALLOW_METHODS
+        headers['Access-Control-Allow-Headers'] = CORS_ALLOW_HEADERS
+    else:
+        headers['Access-Control-Expose-Headers'] = CORS_EXPOSE_HEADERS
+    return response
 
 def get_prompter():
     model_id = os.environ.get('MODEL_ID', 'anthropic.claude-3-haiku-20240307-v1:0')
     region = os.environ.get('AWS_REGION', 'us-east-1')
+    latency = os.environ.get('BEDROCK_LATENCY')
     state = ConversationState()
-    return LLMPrompter(state, aws_region=region, model_id=model_id)
+    return LLMPrompter(state, aws_region=region, model_id=model_id, latency=latency)
 
 def get_session_prompter():
-    if 'conversation_state' in session:
-        try:
-            state_data = session['conversation_state']
-            conversation_state = ConversationState.from_dict(state_data)
-            model_id = os.environ.get('MODEL_ID', 'anthropic.claude-3-haiku-20240307-v1:0')
-            region = os.environ.get('AWS_REGION', 'us-east-1')
-            return LLMPrompter(conversation_state, aws_region=region, model_id=model_id)
-        except Exception as e:
-            print(f"Error loading conversation state from session: {e}")
+    try:
+        state_data = session_store.load(session)
+        if not state_data:
             return get_prompter()
-    else:
+        conversation_state = ConversationState.from_dict(state_data)
+        model_id = os.environ.get('MODEL_ID', 'anthropic.claude-3-haiku-20240307-v1:0')
+        region = os.environ.get('AWS_REGION', 'us-east-1')
+        latency = os.environ.get('BEDROCK_LATENCY')
+        return LLMPrompter(conversation_state, aws_region=region, model_id=model_id, latency=latency)
+    except Exception as e:
+        logger.error("Error loading conversation state from session: %s", e)
         return get_prompter()
 
 def save_session_prompter(prompter):
+    if not prompter.conversation_state.is_dirty():
+        return
     try:
-        session['conversation_state'] = prompter.conversation_state.to_dict()
         session.permanent = True
         if 'session_id' not in session:
-            session['session_id'] = str(uuid4())
+            session['session_id'] = secrets.token_hex(16)
+        session_store.save(session, prompter.conversation_state.to_dict())
+        prompter.conversation_state.mark_clean()
     except Exception as e:
-        print(f"Error saving conversation state to session: {e}")
+        logger.error("Error saving conversation state to session: %s", e)
 
 @app.route('/load_scenario', methods=['POST'])
 def load_scenario():
     data = request.get_json()
     scenario = data.get('scenario')
-    print(scenario)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug('load_scenario scenario=%s headers=%s cookies=%s session_keys=%s',
+                     scenario, dict(request.headers), request.cookies.to_dict(), list(session.keys()))
     if not scenario:
         return jsonify({'error': 'Missing scenario_name or scenario_path'}), 400
     try:
@@ -109,17 +139,46 @@ def health_check():
 
 @app.route('/session/clear', methods=['POST'])
 def clear_session():
+    try:
+        session_store.clear(session)
+    except Exception as e:
+        logger.error("Error clearing conversation state: %s", e)
     session.clear()
     return jsonify({'status': 'session_cleared'})
 
 @app.route('/session/info', methods=['GET'])
 def session_info():
-    has_conversation_state = 'conversation_state' in session
+    try:
+        has_conversation_state = session_store.has_state(session)
+    except Exception as e:
+        logger.error("Error checking conversation state: %s", e)
+        has_conversation_state = False
     return jsonify({
         'has_prompter_state': has_conversation_state,
         'session_id': session.get('session_id', 'none')
     })
 
+_HEALTH_BODY = b'{"status":"healthy","service":"aws-language-chat-buddy"}'
+_HEALTH_HEADERS = [('Content-Type', 'application/json'), ('Content-Length', str(len(_HEALTH_BODY)))]
+
+class HealthShortCircuit:
+    """Answer load balancer health probes before Flask parses cookies, sessions or routes.
+
+    Browser requests (with an Origin header) still go through Flask so they get CORS headers.
+    """
+    def __init__(self, wsgi_app):
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        if (environ.get('PATH_INFO') == '/health'
+                and environ.get('REQUEST_METHOD') in ('GET', 'HEAD')
+                and 'HTTP_ORIGIN' not in environ):
+            start_response('200 OK', _HEALTH_HEADERS)
+            return [_HEALTH_BODY]
+        return self.wsgi_app(environ, start_response)
+
+app.wsgi_app = HealthShortCircuit(app.wsgi_app)
+
 @app.errorhandler(404)
 def not_found(error):
     return jsonify({'error': 'Endpoint not found'}), 404
@@ -129,4 +188,5 @@ def internal_error(error):
     return jsonify({'error': 'Internal server error'}), 500
 
 if __name__ == '__main__':
+    logging.basicConfig(level=logger.level)
     app.run(debug=True)
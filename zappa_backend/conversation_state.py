@@ -1,52 +1,199 @@
-import json
 import os
-from typing import Dict, Any, Optional
-from dataclasses import dataclass, asdict
+import re
+import orjson
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Dict, Any, Mapping, Optional, Tuple
+from dataclasses import dataclass, field
 from datetime import datetime
 
-@dataclass
+IS_LAMBDA = os.environ.get('AWS_LAMBDA_FUNCTION_NAME') is not None
+
+_BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+SCENARIO_DIR = os.path.join(_BASE_DIR, 'scenarios')
+# Single pre-parsed file written by pack_scenarios.py at deploy time
+SCENARIO_BUNDLE_PATH = os.path.join(_BASE_DIR, 'scenarios.json')
+
+REQUIRED_SCENARIO_FIELDS = frozenset({
+    'scenario_id', 'scenario_name', 'teacher_persona',
+    'conversation_events', 'variables', 'progress_tracking'
+})
+
+# Keys accepted by ConversationState.from_dict; anything missing takes the field default
+STATE_FIELDS = frozenset({
+    'scenario_name', 'current_event_index', 'variables', 'attempts', 'created_at',
+    'last_response_hash', 'last_event_index', 'last_result'
+})
+
+@dataclass(slots=True, frozen=True)
+class ConversationEvent:
+    """One step of a scenario, with optional fields resolved to defaults once at load time"""
+    event_id: Any = None
+    type: str = ""
+    text: str = ""
+    text_template: str = ""
+    instruction: str = ""
+    expecting_input: bool = False
+    evaluation_focus: Tuple[str, ...] = ()
+    
+    @classmethod
+    def from_dict(cls, data: Mapping[str, Any]) -> 'ConversationEvent':
+        """Create an event from its scenario JSON"""
+        return cls(
+            event_id=data.get('event_id'),
+            type=data.get('type') or '',
+            text=data.get('text') or '',
+            text_template=data.get('text_template') or '',
+            instruction=data.get('instruction') or '',
+            expecting_input=bool(data.get('expecting_input', False)),
+            evaluation_focus=tuple(data.get('evaluation_focus') or ())
+        )
+
+def _freeze(value: Any) -> Any:
+    """Recursively make parsed JSON read-only so it can be shared between requests"""
+    if isinstance(value, dict):
+        return MappingProxyType({key: _freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+def _read_scenario_file(file_name: str) -> Optional[Dict[str, Any]]:
+    """Parse a single scenario file, returning None if it can't be read"""
+    try:
+        with open(os.path.join(SCENARIO_DIR, file_name), 'rb') as file:
+            return orjson.loads(file.read())
+    except Exception as e:
+        print(f"Error loading scenario {file_name}: {str(e)}")
+        return None
+
+def read_scenario_files() -> Dict[str, Dict[str, Any]]:
+    """Parse each scenarios/*.json file, keyed by scenario name (file reads overlap in a thread pool)"""
+    file_names = sorted(name for name in os.listdir(SCENARIO_DIR) if name.endswith('.json'))
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        parsed = executor.map(_read_scenario_file, file_names)
+        return {
+            os.path.splitext(file_name)[0]: scenario_data
+            for file_name, scenario_data in zip(file_names, parsed)
+            if scenario_data is not None
+        }
+
+def _read_scenario_bundle() -> Optional[Dict[str, Dict[str, Any]]]:
+    """Read the packed bundle written at deploy time, if there is one"""
+    try:
+        with open(SCENARIO_BUNDLE_PATH, 'rb') as file:
+            return orjson.loads(file.read())
+    except FileNotFoundError:
+        return None
+
+def _prepare_scenario(scenario_name: str, scenario_data: Dict[str, Any]) -> Optional[Mapping[str, Any]]:
+    """Validate a parsed scenario and freeze it for sharing"""
+    missing_fields = REQUIRED_SCENARIO_FIELDS - scenario_data.keys()
+    if missing_fields:
+        print(f"Skipping scenario {scenario_name}: missing fields {sorted(missing_fields)}")
+        return None
+    
+    # Scenarios are read many times and never modified, so build the events and index them by ID once
+    events = tuple(ConversationEvent.from_dict(event) for event in scenario_data['conversation_events'])
+    event_id_index = {}
+    for index, event in enumerate(events):
+        event_id_index.setdefault(event.event_id, index)
+    return _freeze({**scenario_data, 'conversation_events': events, '_event_id_index': event_id_index})
+
+def _load_all_scenarios() -> Dict[str, Mapping[str, Any]]:
+    """Parse every scenario once, at import time (outside the Lambda handler)"""
+    raw_scenarios = _read_scenario_bundle()
+    if raw_scenarios is None:
+        raw_scenarios = read_scenario_files()
+    
+    scenarios = {}
+    for scenario_name, scenario_data in raw_scenarios.items():
+        prepared = _prepare_scenario(scenario_name, scenario_data)
+        if prepared is not None:
+            scenarios[scenario_name] = prepared
+    return scenarios
+
+@lru_cache(maxsize=32)
+def _load_scenario_file(file_name: str, mtime_ns: int) -> Optional[Mapping[str, Any]]:
+    """Parse one scenario file; the mtime in the cache key drops stale entries after an edit"""
+    scenario_data = _read_scenario_file(file_name)
+    if scenario_data is None:
+        return None
+    return _prepare_scenario(os.path.splitext(file_name)[0], scenario_data)
+
+def get_scenario(scenario_name: str) -> Optional[Mapping[str, Any]]:
+    """Get the read-only data for a scenario by name"""
+    if IS_LAMBDA:
+        return _SCENARIOS.get(scenario_name)
+    
+    # Local runs re-parse a scenario only when its file changes, so edits show up without a restart
+    if os.path.basename(scenario_name) != scenario_name:
+        return None
+    file_name = f'{scenario_name}.json'
+    try:
+        mtime_ns = os.stat(os.path.join(SCENARIO_DIR, file_name)).st_mtime_ns
+    except OSError:
+        return None
+    return _load_scenario_file(file_name, mtime_ns)
+
+# Deployed scenarios never change, so Lambda parses them all once at cold start
+_SCENARIOS = MappingProxyType(_load_all_scenarios() if IS_LAMBDA else {})
+
+# Marks a scenario cache that has not been filled yet, so a missing scenario (None) is cached too
+_NOT_LOADED = object()
+
+@dataclass(slots=True)
 class ConversationState:
     """Minimal serializable conversation state for session storage"""
     scenario_name: str = ""
     current_event_index: int = 0
-    variables: Dict[str, Any] = None
+    variables: Dict[str, Any] = field(default_factory=dict)
     attempts: int = 0
     created_at: str = ""
+    # Last evaluated response, so an identical resubmission at the same event is answered without Bedrock
+    last_response_hash: str = ""
+    last_event_index: int = -1
+    last_result: Optional[Dict[str, Any]] = None
+    # Set by every mutator so callers can skip persisting unchanged state
+    _dirty: bool = field(default=False, init=False, repr=False, compare=False)
+    # Scenario data fetched by this instance, reused for the rest of the request
+    _scenario_cache: Any = field(default=_NOT_LOADED, init=False, repr=False, compare=False)
+    
+    _VAR_RE = re.compile(r'\{([a-zA-Z_]\w*)\}')
     
     def __post_init__(self):
-        if self.variables is None:
-            self.variables = {}
         if not self.created_at:
             self.created_at = datetime.now().isoformat()
     
-    def _load_scenario_data(self) -> Optional[Dict[str, Any]]:
-        """Load scenario data from disk - not stored in session"""
+    def _load_scenario_data(self) -> Optional[Mapping[str, Any]]:
+        """Get the pre-parsed, read-only scenario data - not stored in session"""
         if not self.scenario_name:
             return None
+        if self._scenario_cache is not _NOT_LOADED:
+            return self._scenario_cache
         
-        # Construct path to scenario file
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        scenario_path = os.path.join(current_dir, 'scenarios', f'{self.scenario_name}.json')
-        
-        try:
-            with open(scenario_path, 'r', encoding='utf-8') as file:
-                return json.load(file)
-        except Exception as e:
-            print(f"Error loading scenario {self.scenario_name}: {str(e)}")
-            return None
+        scenario_data = get_scenario(self.scenario_name)
+        if scenario_data is None:
+            print(f"Error loading scenario {self.scenario_name}: scenario not found")
+        self._scenario_cache = scenario_data
+        return scenario_data
     
     def initialize_scenario(self, scenario_name: str) -> None:
         """Initialize a new scenario"""
         self.scenario_name = scenario_name
+        self._scenario_cache = _NOT_LOADED
         self.current_event_index = 0
         self.attempts = 0
+        self.clear_last_result()
+        self._dirty = True
         
         # Load scenario data to initialize variables
         scenario_data = self._load_scenario_data()
         if scenario_data:
-            self.variables = scenario_data.get('variables', {}).copy()
+            scenario_variables = scenario_data.get('variables')
+            self.variables = dict(scenario_variables) if scenario_variables else {}
     
-    def get_current_event(self) -> Optional[Dict[str, Any]]:
+    def get_current_event(self) -> Optional[ConversationEvent]:
         """Get the current conversation event"""
         scenario_data = self._load_scenario_data()
         if not scenario_data:
@@ -64,65 +211,78 @@ class ConversationState:
         if not scenario_data:
             return False
         
-        events = scenario_data.get('conversation_events', [])
-        for i, event in enumerate(events):
-            if event.get('event_id') == event_id:
-                self.current_event_index = i
-                self.attempts = 0
-                return True
-        return False
+        index = scenario_data['_event_id_index'].get(event_id)
+        if index is None:
+            return False
+        self.current_event_index = index
+        self.attempts = 0
+        self._dirty = True
+        return True
     
-    def get_event_by_id(self, event_id: int) -> Optional[Dict[str, Any]]:
+    def get_event_by_id(self, event_id: int) -> Optional[ConversationEvent]:
         """Get an event by its ID"""
         scenario_data = self._load_scenario_data()
         if not scenario_data:
             return None
         
-        events = scenario_data.get('conversation_events', [])
-        for event in events:
-            if event.get('event_id') == event_id:
-                return event
-        return None
+        index = scenario_data['_event_id_index'].get(event_id)
+        if index is None:
+            return None
+        return scenario_data['conversation_events'][index]
     
     def advance_to_next_event(self) -> None:
         """Move to the next conversation event"""
         self.current_event_index += 1
         self.attempts = 0
+        self._dirty = True
     
     def increment_attempts(self) -> None:
         """Increment attempt counter for current event"""
         self.attempts += 1
+        self._dirty = True
     
     def update_variables(self, new_variables: Dict[str, Any]) -> None:
         """Update conversation variables"""
-        for key, value in new_variables.items():
-            if key in self.variables:
-                self.variables[key] = value
+        variables = self.variables
+        # Only variables the scenario declares are updated
+        for key in new_variables.keys() & variables.keys():
+            value = new_variables[key]
+            if variables[key] != value:
+                variables[key] = value
+                self._dirty = True
     
     def replace_template_variables(self, template: str) -> str:
         """Replace template variables with actual values"""
-        result = template
-        for var_name, var_value in self.variables.items():
-            if var_value is not None:
-                result = result.replace(f'{{{var_name}}}', str(var_value))
-        return result
-    
-    def get_current_prompt(self) -> str:
-        """Get the current prompt for the conversation"""
-        scenario_data = self._load_scenario_data()
-        if not scenario_data:
-            return "No scenario loaded. Please load a scenario first."
+        # Most scenario text has no placeholders; skip the regex scan entirely
+        if '{' not in template:
+            return template
+        variables = self.variables
         
-        current_event = self.get_current_event()
+        def substitute(match):
+            # Unknown or unset variables keep their placeholder
+            value = variables.get(match.group(1))
+            return match.group(0) if value is None else str(value)
+        
+        return self._VAR_RE.sub(substitute, template)
+    
+    def get_current_prompt(self, current_event: Optional[ConversationEvent] = None) -> str:
+        """Get the current prompt for the conversation.
+
+        Callers that already fetched the current event can pass it in to skip the lookup.
+        """
+        if current_event is None:
+            scenario_data = self._load_scenario_data()
+            if not scenario_data:
+                return "No scenario loaded. Please load a scenario first."
+            current_event = self.get_current_event()
         if not current_event:
             return "Conversation completed! Great job!"
         
-        if current_event.get('text'):
+        if current_event.text:
             # This is a direct text prompt (teacher initial, guidance, feedback, or final)
-            return current_event.get('text', '')
-        elif current_event.get('text_template'):
-            text_template = current_event.get('text_template', '')
-            return self.replace_template_variables(text_template)
+            return current_event.text
+        elif current_event.text_template:
+            return self.replace_template_variables(current_event.text_template)
         return "Continue the conversation..."
     
     def current_event_expects_input(self) -> bool:
@@ -130,7 +290,7 @@ class ConversationState:
         current_event = self.get_current_event()
         if not current_event:
             return False
-        return current_event.get('expecting_input', False)
+        return current_event.expecting_input
     
     def validate_event_sequence(self) -> bool:
         """Validate that event IDs are sequential and match array indices"""
@@ -140,8 +300,8 @@ class ConversationState:
         
         events = scenario_data.get('conversation_events', [])
         for i, event in enumerate(events):
-            if event.get('event_id') != i:
-                print(f"Event ID mismatch: expected {i}, got {event.get('event_id')}")
+            if event.event_id != i:
+                print(f"Event ID mismatch: expected {i}, got {event.event_id}")
                 return False
         return True
     
@@ -156,11 +316,42 @@ class ConversationState:
     
     def reset_conversation(self) -> None:
         """Reset conversation to the beginning"""
+        self._scenario_cache = _NOT_LOADED
         scenario_data = self._load_scenario_data()
         if scenario_data:
-            self.variables = scenario_data.get('variables', {}).copy()
+            scenario_variables = scenario_data.get('variables')
+            self.variables = dict(scenario_variables) if scenario_variables else {}
             self.current_event_index = 0
             self.attempts = 0
+            self.clear_last_result()
+            self._dirty = True
+    
+    def get_repeated_result(self, response_hash: str) -> Optional[Dict[str, Any]]:
+        """Get the previous result if the same response was already evaluated for the current event"""
+        if response_hash == self.last_response_hash and self.current_event_index == self.last_event_index:
+            return self.last_result
+        return None
+    
+    def record_result(self, response_hash: str, event_index: int, result: Dict[str, Any]) -> None:
+        """Remember a needs_correction result for a response at the given event"""
+        self.last_response_hash = response_hash
+        self.last_event_index = event_index
+        self.last_result = result
+        self._dirty = True
+    
+    def clear_last_result(self) -> None:
+        """Forget the last evaluated response"""
+        self.last_response_hash = ""
+        self.last_event_index = -1
+        self.last_result = None
+    
+    def is_dirty(self) -> bool:
+        """Check if the state changed since it was loaded or last saved"""
+        return self._dirty
+    
+    def mark_clean(self) -> None:
+        """Record that the current state has been persisted"""
+        self._dirty = False
     
     def to_dict(self) -> Dict[str, Any]:
         """Convert to dictionary for serialization - only minimal state"""
@@ -169,19 +360,19 @@ class ConversationState:
             'current_event_index': self.current_event_index,
             'variables': self.variables,
             'attempts': self.attempts,
-            'created_at': self.created_at
+            'created_at': self.created_at,
+            'last_response_hash': self.last_response_hash,
+            'last_event_index': self.last_event_index,
+            'last_result': self.last_result
         }
     
     @classmethod
     def from_dict(cls, data: Dict[str, Any]) -> 'ConversationState':
         """Create instance from dictionary"""
-        return cls(
-            scenario_name=data.get('scenario_name', ''),
-            current_event_index=data.get('current_event_index', 0),
-            variables=data.get('variables', {}),
-            attempts=data.get('attempts', 0),
-            created_at=data.get('created_at', '')
-        )
+        state = cls(**{key: value for key, value in data.items() if key in STATE_FIELDS})
+        if state.variables is None:
+            state.variables = {}
+        return state
     
     def get_state_summary(self) -> Dict[str, Any]:
         """Get a summary of the current state"""
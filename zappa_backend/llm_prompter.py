@@ -1,14 +1,20 @@
-import json
-import boto3
+import hashlib
+import os
+import re
+import threading
 import logging
-from typing import Dict, Any, List, Optional
+import orjson
+from collections import OrderedDict
+from contextlib import closing
+from functools import lru_cache
+from typing import Dict, Any, Iterator, List, Optional, Tuple
 from dataclasses import dataclass
 from enum import Enum
-from conversation_state import ConversationState
+from conversation_state import ConversationState, ConversationEvent
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# Handlers come from the Lambda runtime (or the __main__ example below)
 logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG if os.environ.get('DEBUG') else logging.INFO)
 
 class ResponseType(Enum):
     CORRECT = "correct"
@@ -16,6 +22,13 @@ class ResponseType(Enum):
     INCOMPLETE = "incomplete"
     INVALID = "invalid"
 
+# Model ratings in the casings it returns them in; anything else counts as INVALID
+_RATING_MAP = {
+    value: response_type
+    for response_type in ResponseType
+    for value in (response_type.value, response_type.value.upper(), response_type.value.capitalize())
+}
+
 @dataclass
 class EvaluationResult:
     response_type: ResponseType
@@ -24,9 +37,292 @@ class EvaluationResult:
     feedback: str
     corrected_response: Optional[str] = None
     next_prompt: Optional[str] = None
+    # False when the result is a fallback for a failed or unparseable model call
+    cacheable: bool = True
+
+# Prompt scaffolding, built once; only the per-turn fields are filled in
+_EVALUATION_PROMPT_TMPL = """You are an English language teacher helping a student improve their grammar.
+            Please respond ONLY in the following JSON format:
+            {{
+            "is_correct": true or false,
+            "corrected_response": "corrected version if needed",
+            "explanation": "brief explanation",
+            "rating": "CORRECT or GRAMMAR_ERROR or INCOMPLETE or INVALID"{extraction_format}
+            }}
+
+            Student's response: \"{student_response}\"
+
+            Focus areas: {focus_areas}
+            {extraction_context}
+        """
+
+_EXTRACTION_FORMAT = """,
+            "extracted_info": {"variable name": "value found in the student's response"},
+            "is_complete": true or false"""
+
+_EXTRACTION_CONTEXT_TMPL = """
+            What we're looking for: {instruction}
+            Variables to extract (use these names as keys): {variable_names}
+            """
+
+# Several responses in one call; each item reuses the extraction context above
+_BATCH_EVALUATION_PROMPT_TMPL = """You are an English language teacher helping a student improve their grammar.
+            Evaluate each numbered student response below on its own.
+            Please respond ONLY with a JSON array holding one object per response, in the same order:
+            [
+            {{
+            "index": response number,
+            "is_correct": true or false,
+            "corrected_response": "corrected version if needed",
+            "explanation": "brief explanation",
+            "rating": "CORRECT or GRAMMAR_ERROR or INCOMPLETE or INVALID",
+            "extracted_info": {{"variable name": "value found in the student's response"}},
+            "is_complete": true or false
+            }}
+            ]
+            Use an empty extracted_info object for responses with nothing to extract.
+            {items}
+        """
+
+# Output tokens allowed per batch call (the limit for Claude 3 Haiku and Titan Text Lite),
+# and a generous estimate of the tokens one verdict takes
+_BATCH_MAX_TOKENS = 4096
+_BATCH_TOKENS_PER_RESPONSE = 300
+_BATCH_SIZE = _BATCH_MAX_TOKENS // _BATCH_TOKENS_PER_RESPONSE
+
+_BATCH_ITEM_TMPL = """
+            Response {index}: \"{student_response}\"
+            Focus areas: {focus_areas}
+            {extraction_context}"""
+
+# The evaluation prompt around the student's response depends only on the event and the
+# scenario's variable names, so each event's scaffolding is rendered once and reused
+_EVALUATION_PROMPT_HEAD, _, _EVALUATION_PROMPT_TAIL = _EVALUATION_PROMPT_TMPL.partition('{student_response}')
+
+def _extraction_context(event: ConversationEvent, variable_names: str) -> str:
+    """Describe what to extract for an input event (empty for other events)"""
+    if not event.expecting_input:
+        return ""
+    return _EXTRACTION_CONTEXT_TMPL.format(instruction=event.instruction, variable_names=variable_names)
+
+@lru_cache(maxsize=256)
+def _evaluation_prompt_parts(event: ConversationEvent, variable_names: str) -> Tuple[str, str]:
+    """Render the evaluation prompt before and after the student's response for one event"""
+    head = _EVALUATION_PROMPT_HEAD.format(
+        extraction_format=_EXTRACTION_FORMAT if event.expecting_input else ""
+    )
+    tail = _EVALUATION_PROMPT_TAIL.format(
+        focus_areas=", ".join(event.evaluation_focus),
+        extraction_context=_extraction_context(event, variable_names)
+    )
+    return head, tail
+
+# Claude returns the evaluation as tool input through the Converse API, so the verdict
+# arrives as a schema-shaped dict instead of JSON embedded in free text
+_EVALUATION_TOOL_NAME = 'report_evaluation'
+_EVALUATION_TOOL_SPEC = {
+    'name': _EVALUATION_TOOL_NAME,
+    'description': "Report the evaluation of the student's response.",
+    'inputSchema': {'json': {
+        'type': 'object',
+        'properties': {
+            'is_correct': {'type': 'boolean'},
+            'corrected_response': {'type': 'string', 'description': 'Corrected version if needed'},
+            'explanation': {'type': 'string', 'description': 'Brief explanation'},
+            'rating': {'type': 'string', 'enum': ['CORRECT', 'GRAMMAR_ERROR', 'INCOMPLETE', 'INVALID']},
+            'extracted_info': {
+                'type': 'object',
+                'description': "Variable name to the value found in the student's response",
+                'additionalProperties': {'type': 'string'}
+            },
+            'is_complete': {'type': 'boolean'}
+        },
+        'required': ['is_correct', 'explanation', 'rating']
+    }}
+}
+
+# Claude 2 and Instant predate tool use on Bedrock
+_LEGACY_CLAUDE_MARKERS = ('claude-v2', 'claude-instant')
+
+# Keep-alive connections with a pool large enough for concurrent requests in a warm container,
+# and a short connect timeout so a bad connection fails over to a retry quickly. The read
+# timeout stays at botocore's 60s default, since a full batch evaluation can generate 4096 tokens
+_BEDROCK_CLIENT_CONFIG = {
+    'tcp_keepalive': True,
+    'max_pool_connections': 32,
+    'retries': {'max_attempts': 2, 'mode': 'standard'},
+    'connect_timeout': 3
+}
+
+# bedrock-runtime clients by region, shared by every LLMPrompter in the process
+_BEDROCK_CLIENTS: Dict[str, Any] = {}
+_BEDROCK_CLIENTS_LOCK = threading.Lock()
+
+def _get_shared_bedrock_client(aws_region: str):
+    """Get the process-wide bedrock-runtime client for a region, creating it on first use"""
+    client = _BEDROCK_CLIENTS.get(aws_region)
+    if client is None:
+        with _BEDROCK_CLIENTS_LOCK:
+            client = _BEDROCK_CLIENTS.get(aws_region)
+            if client is None:
+                # Imported here so endpoints that never call Bedrock don't pay for boto3
+                import boto3
+                from botocore.config import Config
+                client = boto3.client(
+                    'bedrock-runtime',
+                    region_name=aws_region,
+                    config=Config(**_BEDROCK_CLIENT_CONFIG)
+                )
+                _BEDROCK_CLIENTS[aws_region] = client
+    return client
+
+def _evict_shared_bedrock_client(aws_region: str, client) -> None:
+    """Drop a region's shared client so the next call builds one with a fresh connection pool"""
+    with _BEDROCK_CLIENTS_LOCK:
+        if _BEDROCK_CLIENTS.get(aws_region) is client:
+            del _BEDROCK_CLIENTS[aws_region]
+
+@lru_cache(maxsize=None)
+def _stale_connection_error_types() -> Tuple[type, ...]:
+    """Exception types raised when a pooled connection was already dropped by the peer.
+
+    Imported on first use, which is always after boto3 has been loaded for the failing call.
+    EndpointConnectionError is left out: it means the endpoint itself is unreachable.
+    """
+    from botocore.exceptions import ConnectionClosedError
+    from urllib3.exceptions import ProtocolError
+    # http.client.RemoteDisconnected is a ConnectionResetError
+    return (ConnectionClosedError, ProtocolError, ConnectionResetError)
+
+def _is_stale_connection_error(error: BaseException) -> bool:
+    """Check if an error (or one it was raised from) came from a dead pooled connection"""
+    stale_types = _stale_connection_error_types()
+    seen = set()
+    while error is not None and id(error) not in seen:
+        seen.add(id(error))
+        if isinstance(error, stale_types):
+            return True
+        # urllib3 raises a bare AssertionError from inside its own modules when it reuses a
+        # connection the peer (or a NAT gateway) already dropped
+        if isinstance(error, AssertionError):
+            traceback = error.__traceback__
+            while traceback is not None:
+                module = traceback.tb_frame.f_globals.get('__name__', '')
+                if module.startswith(('urllib3.', 'botocore.')):
+                    return True
+                traceback = traceback.tb_next
+        error = error.__cause__ or error.__context__
+    return False
+
+# Span from the first '{' to the last '}', so JSON wrapped in prose still parses
+_JSON_BLOB_RE = re.compile(r'\{.*\}', re.DOTALL)
+_JSON_ARRAY_RE = re.compile(r'\[.*\]', re.DOTALL)
+
+def _parse_json_blob(text: str) -> Optional[Dict[str, Any]]:
+    """Parse the JSON object embedded in model output, or None if there isn't a valid one"""
+    match = _JSON_BLOB_RE.search(text)
+    if not match:
+        return None
+    try:
+        return orjson.loads(match.group(0))
+    except orjson.JSONDecodeError:
+        return None
+
+def _parse_json_array(text: str) -> Optional[List[Any]]:
+    """Parse the JSON array embedded in model output, or None if there isn't a valid one"""
+    match = _JSON_ARRAY_RE.search(text)
+    if not match:
+        return None
+    try:
+        data = orjson.loads(match.group(0))
+    except orjson.JSONDecodeError:
+        return None
+    return data if isinstance(data, list) else None
+
+class _JsonObjectTracker:
+    """Follows brace depth across streamed text (ignoring braces inside strings) to find
+    where the first top-level JSON object ends"""
+    __slots__ = ('depth', 'in_string', 'escaped')
+
+    def __init__(self):
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+
+    def feed(self, text: str) -> int:
+        """Consume a chunk; return the index just past the closing brace, or -1 if not reached yet"""
+        for i, char in enumerate(text):
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == '\\':
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                if self.depth:
+                    self.in_string = True
+            elif char == '{':
+                self.depth += 1
+            elif char == '}' and self.depth:
+                self.depth -= 1
+                if not self.depth:
+                    return i + 1
+        return -1
+
+class _LRUCache:
+    """Thread-safe LRU map shared by the requests handled in this process"""
+    __slots__ = ('max_size', '_entries', '_lock')
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._entries: "OrderedDict[bytes, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: bytes) -> Any:
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: bytes, value: Any) -> None:
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+# Evaluations keyed by (scenario, event index, trimmed response), so a repeated
+# answer skips Bedrock entirely
+_EVALUATION_CACHE = _LRUCache(max_size=4096)
+
+# Replies that can never carry the information an input event asks for: no letters or
+# digits at all, or a bare acknowledgement
+_TRIVIAL_RESPONSE_RE = re.compile(r'^\W*(?:(?:y|yes|yeah|yep|n|no|nope|ok|okay|k|sure|hmm+|um+)\W*)?$', re.IGNORECASE)
+
+def _evaluate_trivial_response(student_response: str, current_event: ConversationEvent) -> Optional[EvaluationResult]:
+    """Answer a trivially incomplete response locally, or None if it needs the model"""
+    if not current_event.expecting_input or not _TRIVIAL_RESPONSE_RE.match(student_response):
+        return None
+    return EvaluationResult(
+        response_type=ResponseType.INCOMPLETE,
+        is_valid=False,
+        extracted_variables={},
+        feedback="Please tell me a little more so I can understand your answer.",
+        corrected_response=None,
+        next_prompt=None,
+        cacheable=False
+    )
+
+def _evaluation_cache_key(scenario_name: str, event_index: int, student_response: str) -> bytes:
+    """Hash the cache key so long responses don't bloat the cache"""
+    # Capitalization and spacing are part of what the grammar check judges, so only the ends are trimmed
+    key = f"{scenario_name}\x00{event_index}\x00{student_response.strip()}".encode('utf-8')
+    return hashlib.blake2b(key, digest_size=16).digest()
 
 class LLMPrompter:
-    def __init__(self, conversation_state: ConversationState = None, aws_region: str = 'us-east-1', model_id: str = 'anthropic.claude-3-sonnet-20240229-v1:0'):
+    def __init__(self, conversation_state: ConversationState = None, aws_region: str = 'us-east-1', model_id: str = 'anthropic.claude-3-sonnet-20240229-v1:0', bedrock_client=None, latency: Optional[str] = None):
         """
         Initialize the LLM Prompter with conversation state
         
@@ -34,15 +330,36 @@ class LLMPrompter:
             conversation_state: ConversationState instance (creates new if None)
             aws_region: AWS region for Bedrock
             model_id: Model ID for Bedrock
+            bedrock_client: bedrock-runtime client to use (defaults to the shared client for aws_region)
+            latency: Bedrock performance config, 'optimized' or 'standard' (defaults to the model's standard mode)
         """
         self.conversation_state = conversation_state or ConversationState()
         self.aws_region = aws_region
         self.model_id = model_id
-        # Don't store bedrock_client as instance variable to avoid pickling issues
+        self._bedrock_client = bedrock_client
+        # A client passed in belongs to the caller, so it is never swapped out after a connection error
+        self._owns_bedrock_client = bedrock_client is None
+        # Extra invoke arguments; latency-optimized inference is only offered for some models and regions
+        self._invoke_options = {'performanceConfigLatency': latency} if latency else {}
+        self._converse_options = {'performanceConfig': {'latency': latency}} if latency else {}
         
     def _get_bedrock_client(self):
-        """Get bedrock client (created fresh each time to avoid pickling)"""
-        return boto3.client('bedrock-runtime', region_name=self.aws_region)
+        """Get the bedrock client passed in, or the shared client for this region"""
+        if self._bedrock_client is None:
+            self._bedrock_client = _get_shared_bedrock_client(self.aws_region)
+        return self._bedrock_client
+    
+    def _call_bedrock(self, operation: str, **kwargs) -> Dict[str, Any]:
+        """Call a bedrock-runtime operation, retrying once on a new client if the pooled connection was stale"""
+        try:
+            return getattr(self._get_bedrock_client(), operation)(**kwargs)
+        except Exception as e:
+            if not self._owns_bedrock_client or not _is_stale_connection_error(e):
+                raise
+            logger.warning("Stale Bedrock connection, retrying with a new client: %s", e)
+            _evict_shared_bedrock_client(self.aws_region, self._bedrock_client)
+            self._bedrock_client = None
+            return getattr(self._get_bedrock_client(), operation)(**kwargs)
         
     def initialize_scenario(self, scenario_name: str) -> None:
         """Initialize a new scenario"""
@@ -50,10 +367,10 @@ class LLMPrompter:
             self.conversation_state.initialize_scenario(scenario_name)
             # Validate event sequence
             if not self.conversation_state.validate_event_sequence():
-                logger.warning(f"Event sequence validation failed for scenario: {scenario_name}")
-            logger.info(f"Initialized scenario: {scenario_name}")
+                logger.warning("Event sequence validation failed for scenario: %s", scenario_name)
+            logger.info("Initialized scenario: %s", scenario_name)
         except Exception as e:
-            logger.error(f"Error initializing scenario: {str(e)}")
+            logger.error("Error initializing scenario: %s", e)
             raise
     
     def jump_to_event(self, event_id: int) -> bool:
@@ -67,191 +384,313 @@ class LLMPrompter:
             return {'event_id': None, 'expecting_input': False, 'has_template': False}
         
         return {
-            'event_id': current_event.get('event_id'),
-            'expecting_input': current_event.get('expecting_input', False),
-            'has_template': bool(current_event.get('text_template')),
-            'has_text': bool(current_event.get('text')),
-            'has_instruction': bool(current_event.get('instruction')),
+            'event_id': current_event.event_id,
+            'expecting_input': current_event.expecting_input,
+            'has_template': bool(current_event.text_template),
+            'has_text': bool(current_event.text),
+            'has_instruction': bool(current_event.instruction),
             'index': self.conversation_state.current_event_index
         }
     
+    def _build_request_body(self, prompt: str, max_tokens: int) -> bytes:
+        """Build the invoke_model request body for the configured model (Claude or Titan)"""
+        if self.model_id.startswith('amazon.titan-text'):
+            # Titan Text models require 'inputText' and 'textGenerationConfig'
+            return orjson.dumps({
+                "inputText": prompt,
+                "textGenerationConfig": {
+                    "maxTokenCount": max_tokens,
+                    "temperature": 0.2
+                }
+            })
+        # Default: Anthropic Claude
+        return orjson.dumps({
+            "anthropic_version": "bedrock-2023-05-31",
+            "max_tokens": max_tokens,
+            "messages": [
+                {
+                    "role": "user",
+                    "content": prompt
+                }
+            ]
+        })
+    
     def _invoke_llm(self, prompt: str, max_tokens: int = 1000) -> str:
         """Invoke AWS Bedrock LLM with the given prompt, supporting both Claude and Titan."""
-        bedrock_client = self._get_bedrock_client()
         try:
-            model_id = self.model_id
-            if model_id.startswith('amazon.titan-text'):
-                # Titan Text models require 'inputText' and 'textGenerationConfig'
-                body = json.dumps({
-                    "inputText": prompt,
-                    "textGenerationConfig": {
-                        "maxTokenCount": max_tokens,
-                        "temperature": 0.2
-                    }
-                })
-                response = bedrock_client.invoke_model(
-                    modelId=model_id,
-                    body=body
-                )
-                response_body = json.loads(response['body'].read())
+            response = self._call_bedrock(
+                'invoke_model',
+                modelId=self.model_id,
+                body=self._build_request_body(prompt, max_tokens),
+                **self._invoke_options
+            )
+            response_body = orjson.loads(response['body'].read())
+            if self.model_id.startswith('amazon.titan-text'):
                 return response_body['results'][0]['outputText']
-            else:
-                # Default: Anthropic Claude
-                body = {
-                    "anthropic_version": "bedrock-2023-05-31",
-                    "max_tokens": max_tokens,
-                    "messages": [
-                        {
-                            "role": "user",
-                            "content": prompt
-                        }
-                    ]
-                }
-                response = bedrock_client.invoke_model(
-                    modelId=model_id,
-                    body=json.dumps(body)
-                )
-                response_body = json.loads(response['body'].read())
-                return response_body['content'][0]['text']
+            return response_body['content'][0]['text']
         except Exception as e:
-            logger.error(f"Error invoking LLM: {str(e)}")
+            logger.error("Error invoking LLM: %s", e)
             raise
     
-    def _create_grammar_check_prompt(self, student_response: str, expected_focus: List[str]) -> str:
-        """Create a prompt for grammar checking and correction, formatted for simpler LLMs like Titan Lite."""
-        focus_areas = ", ".join(expected_focus)
+    def _invoke_llm_json(self, prompt: str, max_tokens: int = 1000) -> str:
+        """Stream the model's answer and stop as soon as the first JSON object is complete.
 
-        prompt = f"""You are an English language teacher helping a student improve their grammar.
-            Please respond ONLY in the following JSON format:
-            {{
-            "is_correct": true or false,
-            "corrected_response": "corrected version if needed",
-            "explanation": "brief explanation",
-            "rating": "CORRECT or GRAMMAR_ERROR or INCOMPLETE or INVALID"
-            }}
-
-            Student's response: \"{student_response}\"
+        Generation is abandoned there, so trailing tokens are never waited for.
+        """
+        tracker = _JsonObjectTracker()
+        chunks = []
+        with closing(self._invoke_llm_stream(prompt, max_tokens)) as stream:
+            for text in stream:
+                end = tracker.feed(text)
+                if end >= 0:
+                    chunks.append(text[:end])
+                    break
+                chunks.append(text)
+        return ''.join(chunks)
+    
+    def _supports_tool_use(self) -> bool:
+        """Check if the configured model can be forced to answer through a tool (Claude 3 and later)"""
+        return 'anthropic.claude' in self.model_id and not any(
+            marker in self.model_id for marker in _LEGACY_CLAUDE_MARKERS
+        )
+    
+    def _invoke_llm_tool(self, prompt: str, tool_spec: Dict[str, Any], max_tokens: int = 1000) -> Optional[Dict[str, Any]]:
+        """Invoke AWS Bedrock through the Converse API, requiring the model to call the given tool.
 
-            Focus areas: {focus_areas}
+        Returns the tool input, or None if the model didn't call the tool.
         """
-        return prompt
+        try:
+            response = self._call_bedrock(
+                'converse',
+                modelId=self.model_id,
+                messages=[{'role': 'user', 'content': [{'text': prompt}]}],
+                inferenceConfig={'maxTokens': max_tokens},
+                toolConfig={
+                    'tools': [{'toolSpec': tool_spec}],
+                    'toolChoice': {'tool': {'name': tool_spec['name']}}
+                },
+                **self._converse_options
+            )
+        except Exception as e:
+            logger.error("Error invoking LLM tool: %s", e)
+            raise
+        
+        for block in response['output']['message']['content']:
+            tool_use = block.get('toolUse')
+            if tool_use and tool_use.get('name') == tool_spec['name']:
+                return tool_use.get('input')
+        return None
     
-    def _create_variable_extraction_prompt(self, student_response: str, current_event: Dict[str, Any]) -> str:
-        """Create a prompt for extracting required variables from student response"""
-        event_instruction = current_event.get('instruction', '')
+    def _invoke_llm_stream(self, prompt: str, max_tokens: int = 1000) -> Iterator[str]:
+        """Invoke AWS Bedrock LLM and yield generated text as it arrives"""
+        is_titan = self.model_id.startswith('amazon.titan-text')
+        try:
+            response = self._call_bedrock(
+                'invoke_model_with_response_stream',
+                modelId=self.model_id,
+                body=self._build_request_body(prompt, max_tokens),
+                **self._invoke_options
+            )
+        except Exception as e:
+            logger.error("Error invoking LLM stream: %s", e)
+            raise
         
-        prompt = f"""
-        You are helping extract information from a student's response in a language learning exercise.
+        stream = response['body']
+        try:
+            for event in stream:
+                chunk = event.get('chunk')
+                if not chunk:
+                    continue
+                chunk_data = orjson.loads(chunk['bytes'])
+                if is_titan:
+                    text = chunk_data.get('outputText')
+                elif chunk_data.get('type') == 'content_block_delta':
+                    text = chunk_data['delta'].get('text')
+                else:
+                    text = None
+                if text:
+                    yield text
+        except Exception as e:
+            logger.error("Error reading LLM stream: %s", e)
+            raise
+        finally:
+            if hasattr(stream, 'close'):
+                stream.close()
+    
+    def _create_evaluation_prompt(self, student_response: str, current_event: ConversationEvent) -> str:
+        """Create one prompt that checks grammar and, for input events, extracts the requested information.
+
+        Formatted for simpler LLMs like Titan Lite.
+        """
+        head, tail = _evaluation_prompt_parts(current_event, ", ".join(self.conversation_state.variables))
+        return head + student_response + tail
+    
+    def _create_batch_evaluation_prompt(self, items: List[Tuple[str, ConversationEvent]]) -> str:
+        """Create one prompt that evaluates several (student response, event) pairs, numbered from 1"""
+        variable_names = ", ".join(self.conversation_state.variables)
+        return _BATCH_EVALUATION_PROMPT_TMPL.format(items="".join(
+            _BATCH_ITEM_TMPL.format(
+                index=index,
+                student_response=student_response,
+                focus_areas=", ".join(event.evaluation_focus),
+                extraction_context=_extraction_context(event, variable_names)
+            )
+            for index, (student_response, event) in enumerate(items, start=1)
+        ))
+    
+    def _evaluate_student_response(self, student_response: str, current_event: ConversationEvent) -> EvaluationResult:
+        """Evaluate student response, reusing a cached evaluation for the same event when available"""
+        trivial_result = _evaluate_trivial_response(student_response, current_event)
+        if trivial_result is not None:
+            return trivial_result
         
-        Student's response: "{student_response}"
-        What we're looking for: {event_instruction}
+        cache_key = _evaluation_cache_key(
+            self.conversation_state.scenario_name,
+            self.conversation_state.current_event_index,
+            student_response
+        )
+        cached_result = _EVALUATION_CACHE.get(cache_key)
+        if cached_result is not None:
+            return cached_result
         
-        Please extract any relevant information and return it as JSON:
-        {{
-            "extracted_info": {{
-                "key": "value pairs of extracted information"
-            }},
-            "confidence": "high|medium|low",
-            "is_complete": boolean
-        }}
-        """
-        return prompt
+        result = self._run_evaluation(student_response, current_event)
+        if result.cacheable:
+            _EVALUATION_CACHE.put(cache_key, result)
+        return result
     
-    def _evaluate_student_response(self, student_response: str, current_event: Dict[str, Any]) -> EvaluationResult:
-        """Evaluate student response for grammar and completeness"""
+    def _run_evaluation(self, student_response: str, current_event: ConversationEvent) -> EvaluationResult:
+        """Evaluate student response for grammar and completeness with a single LLM call"""
         try:
-            # Check grammar
-            evaluation_focus = current_event.get('evaluation_focus', [])
-            grammar_prompt = self._create_grammar_check_prompt(student_response, evaluation_focus)
-            grammar_result = self._invoke_llm(grammar_prompt)
-            
-            # Parse grammar check result
-            try:
-                grammar_data = json.loads(grammar_result)
-            except json.JSONDecodeError:
-                logger.error(f"Failed to parse grammar check result: {grammar_result}")
-                grammar_data = {
-                    "is_correct": False,
-                    "corrected_response": student_response,
-                    "explanation": "Could not analyze response",
-                    "rating": "INVALID"
-                }
-            
-            # Determine response type
-            response_type = ResponseType(grammar_data['rating'].lower())
-            is_valid = grammar_data['is_correct'] and response_type == ResponseType.CORRECT
+            evaluation_prompt = self._create_evaluation_prompt(student_response, current_event)
+            if self._supports_tool_use():
+                evaluation_data = self._invoke_llm_tool(evaluation_prompt, _EVALUATION_TOOL_SPEC)
+                evaluation_output = evaluation_data
+            else:
+                # Titan and older Claude models have no tool use
+                evaluation_output = self._invoke_llm_json(evaluation_prompt)
+                evaluation_data = _parse_json_blob(evaluation_output)
             
-            # If grammar is not correct, return immediately so student knows
-            if not grammar_data.get('is_correct', False):
+            if not isinstance(evaluation_data, dict):
+                logger.error("Failed to parse evaluation result: %s", evaluation_output)
                 return EvaluationResult(
-                    response_type=response_type,
-                    is_valid=is_valid,
+                    response_type=ResponseType.INVALID,
+                    is_valid=False,
                     extracted_variables={},
-                    feedback=grammar_data.get('explanation', ''),
-                    corrected_response=grammar_data.get('corrected_response'),
-                    next_prompt=None
+                    feedback="Could not analyze response",
+                    corrected_response=student_response,
+                    next_prompt=None,
+                    cacheable=False
                 )
             
-            # Extract variables only if grammar is correct
-            extracted_variables = {}
-            if current_event.get('expecting_input', False):
-                extraction_prompt = self._create_variable_extraction_prompt(student_response, current_event)
-                extraction_result = self._invoke_llm(extraction_prompt)
-                try:
-                    extraction_data = json.loads(extraction_result)
-                    extracted_variables = extraction_data.get('extracted_info', {})
-                except json.JSONDecodeError:
-                    logger.error(f"Failed to parse extraction result: {extraction_result}")
-            
-            return EvaluationResult(
-                response_type=response_type,
-                is_valid=is_valid,
-                extracted_variables=extracted_variables,
-                feedback=grammar_data.get('explanation', ''),
-                corrected_response=grammar_data.get('corrected_response'),
-                next_prompt=None
-            )
+            return self._build_evaluation_result(evaluation_data, current_event)
             
         except Exception as e:
-            logger.error(f"Error evaluating student response: {str(e)}")
+            logger.error("Error evaluating student response: %s", e)
             return EvaluationResult(
                 response_type=ResponseType.INVALID,
                 is_valid=False,
                 extracted_variables={},
                 feedback="Sorry, I couldn't understand your response. Please try again.",
                 corrected_response=None,
-                next_prompt=None
+                next_prompt=None,
+                cacheable=False
             )
     
-    def _generate_feedback_prompt(self, evaluation_result: EvaluationResult, teacher_persona: Dict[str, Any]) -> str:
-        """Generate appropriate feedback based on evaluation result"""
-        persona_tone = teacher_persona.get('tone', 'friendly and encouraging')
+    def _build_evaluation_result(self, evaluation_data: Dict[str, Any], current_event: ConversationEvent) -> EvaluationResult:
+        """Turn the model's parsed JSON verdict into an EvaluationResult"""
+        # Determine response type
+        response_type = _RATING_MAP.get(evaluation_data.get('rating', ''), ResponseType.INVALID)
+        # Text-path JSON has no schema behind it, so field types are checked before use
+        is_correct = evaluation_data.get('is_correct') is True
+        is_valid = is_correct and response_type == ResponseType.CORRECT
         
-        if evaluation_result.response_type == ResponseType.CORRECT:
-            feedback_prompt = f"""
-            You are {teacher_persona.get('name', 'a teacher')} with a {persona_tone} personality.
-            The student gave a correct response. Provide positive, encouraging feedback.
-            Keep it brief and enthusiastic.
-            """
-        elif evaluation_result.response_type == ResponseType.GRAMMAR_ERROR:
-            feedback_prompt = f"""
-            You are {teacher_persona.get('name', 'a teacher')} with a {persona_tone} personality.
-            The student made a grammar error. 
-            
-            Original response: "{evaluation_result.corrected_response}"
-            Corrected version: "{evaluation_result.corrected_response}"
-            
-            Provide gentle correction with encouragement. Say the corrected version and ask them to try again.
-            """
-        else:
-            feedback_prompt = f"""
-            You are {teacher_persona.get('name', 'a teacher')} with a {persona_tone} personality.
-            The student's response was incomplete or unclear.
-            
-            Provide gentle guidance and ask them to try again with more specific direction.
-            """
+        # Extracted information only counts once the grammar is correct
+        extracted_variables = {}
+        if is_correct and current_event.expecting_input:
+            extracted_info = evaluation_data.get('extracted_info')
+            if isinstance(extracted_info, dict):
+                extracted_variables = extracted_info
+        
+        return EvaluationResult(
+            response_type=response_type,
+            is_valid=is_valid,
+            extracted_variables=extracted_variables,
+            feedback=evaluation_data.get('explanation', ''),
+            corrected_response=evaluation_data.get('corrected_response'),
+            next_prompt=None
+        )
+    
+    def _evaluate_batch(self, batch: List[Tuple[str, ConversationEvent]]) -> List[EvaluationResult]:
+        """Evaluate (student response, event) pairs with a single LLM call"""
+        batch_data: List[Any] = []
+        try:
+            batch_prompt = self._create_batch_evaluation_prompt(batch)
+            max_tokens = min(_BATCH_MAX_TOKENS, max(1000, _BATCH_TOKENS_PER_RESPONSE * len(batch)))
+            batch_output = self._invoke_llm(batch_prompt, max_tokens=max_tokens)
+            batch_data = _parse_json_array(batch_output) or []
+        except Exception as e:
+            logger.error("Error evaluating student responses in batch: %s", e)
+        
+        answers = {}
+        for evaluation_data in batch_data:
+            if isinstance(evaluation_data, dict) and isinstance(evaluation_data.get('index'), int):
+                answers[evaluation_data['index']] = evaluation_data
+        
+        results = []
+        for number, (student_response, event) in enumerate(batch, start=1):
+            evaluation_data = answers.get(number)
+            if evaluation_data is not None:
+                try:
+                    results.append(self._build_evaluation_result(evaluation_data, event))
+                    continue
+                except Exception as e:
+                    logger.error("Error reading batch evaluation %d: %s", number, e)
+            # Missing or malformed in the batch answer, so evaluate it on its own
+            results.append(self._run_evaluation(student_response, event))
+        return results
+    
+    def evaluate_student_responses(self, responses: List[Tuple[int, str]]) -> List[EvaluationResult]:
+        """Evaluate (event index, student response) pairs for the loaded scenario in batched LLM calls.
+
+        Conversation state is not changed, so this suits scoring recorded transcripts.
+        Responses the batch answer doesn't cover are evaluated one at a time.
+        """
+        scenario_data = self.conversation_state._load_scenario_data()
+        if not scenario_data:
+            raise ValueError("No scenario loaded")
+        events = scenario_data['conversation_events']
+        scenario_name = self.conversation_state.scenario_name
+        
+        results: List[Optional[EvaluationResult]] = [None] * len(responses)
+        # Keyed like the evaluation cache, so repeats of one answer share a single prompt slot
+        pending: Dict[bytes, Tuple[str, ConversationEvent, List[int]]] = {}
+        for position, (event_index, student_response) in enumerate(responses):
+            if not 0 <= event_index < len(events):
+                raise ValueError(f"No event at index {event_index}")
+            results[position] = _evaluate_trivial_response(student_response, events[event_index])
+            if results[position] is not None:
+                continue
+            cache_key = _evaluation_cache_key(scenario_name, event_index, student_response)
+            results[position] = _EVALUATION_CACHE.get(cache_key)
+            if results[position] is not None:
+                continue
+            if cache_key in pending:
+                pending[cache_key][2].append(position)
+            else:
+                pending[cache_key] = (student_response, events[event_index], [position])
         
-        return self._invoke_llm(feedback_prompt)
+        # Batches are sized so their answers fit within the model's output token limit
+        pending_items = list(pending.items())
+        for start in range(0, len(pending_items), _BATCH_SIZE):
+            batch = pending_items[start:start + _BATCH_SIZE]
+            batch_results = self._evaluate_batch([(student_response, event) for _, (student_response, event, _) in batch])
+            for (cache_key, (_, _, positions)), result in zip(batch, batch_results):
+                if result.cacheable:
+                    _EVALUATION_CACHE.put(cache_key, result)
+                for position in positions:
+                    results[position] = result
+        
+        return results
     
     def _update_conversation_state(self, evaluation_result: EvaluationResult) -> None:
         """Update conversation state based on evaluation result"""
@@ -266,9 +705,9 @@ class LLMPrompter:
             # Increment attempts
             self.conversation_state.increment_attempts()
     
-    def get_current_prompt(self) -> str:
+    def get_current_prompt(self, current_event: Optional[ConversationEvent] = None) -> str:
         """Get the current prompt for the conversation"""
-        return self.conversation_state.get_current_prompt()
+        return self.conversation_state.get_current_prompt(current_event)
     
     def process_student_response(self, student_response: str) -> Dict[str, Any]:
         """Process student response and return next action"""
@@ -278,14 +717,14 @@ class LLMPrompter:
                 'next_prompt': 'Please load a scenario first.'
             }
         
-        if self.conversation_state.is_conversation_complete():
-            return {
-                'message': 'Conversation completed',
-                'next_prompt': 'Great job completing the scenario!'
-            }
-        
+        # Fetched once and reused below; there is no event once the conversation is complete
         current_event = self.conversation_state.get_current_event()
         if not current_event:
+            if self.conversation_state.is_conversation_complete():
+                return {
+                    'message': 'Conversation completed',
+                    'next_prompt': 'Great job completing the scenario!'
+                }
             return {
                 'error': 'No current event',
                 'next_prompt': 'Please reload the scenario.'
@@ -294,43 +733,46 @@ class LLMPrompter:
         if student_response.lower().strip() == 'start':
             return {
                 'status': 'continue',
-                'next_prompt': self.get_current_prompt()
+                'next_prompt': self.get_current_prompt(current_event)
             }
     
         # Only evaluate if this is a student response event
-        if current_event.get('expecting_input', True):
+        if current_event.expecting_input:
+            # Same text resubmitted for the same event: answer from the stored result
+            response_hash = hashlib.blake2b(student_response.encode('utf-8'), digest_size=16).hexdigest()
+            repeated_result = self.conversation_state.get_repeated_result(response_hash)
+            if repeated_result is not None:
+                return repeated_result
+            
+            event_index = self.conversation_state.current_event_index
             evaluation_result = self._evaluate_student_response(student_response, current_event)
             
             if evaluation_result.is_valid:
                 # Update state and move to next event
                 self._update_conversation_state(evaluation_result)
                 
-                # Load scenario data to get teacher persona
-                scenario_data = self.conversation_state._load_scenario_data()
-                teacher_persona = scenario_data.get('teacher_persona', {}) if scenario_data else {}
-                # return None
-                # Generate positive feedback
-                # feedback = self._generate_feedback_prompt(evaluation_result, teacher_persona)
-                
-                return {
+                result = {
                     'status': 'success',
                     'feedback': evaluation_result.feedback,
                     'next_prompt': self.get_current_prompt(),
                     'variables_updated': evaluation_result.extracted_variables
                 }
             else:
-                # Load scenario data to get teacher persona
-                scenario_data = self.conversation_state._load_scenario_data()
-                teacher_persona = scenario_data.get('teacher_persona', {}) if scenario_data else {}
-
-                feedback = self._generate_feedback_prompt(evaluation_result, teacher_persona)
-                return {
+                # The evaluation's explanation is the feedback, so no separate feedback call is made
+                result = {
                     'status': 'needs_correction',
                     'feedback': evaluation_result.feedback,
                     'corrected_response': evaluation_result.corrected_response,
                     'next_prompt': 'Please try again.',
                     'attempt_count': self.conversation_state.attempts
                 }
+            
+            # Only a rejected answer leaves the student on the same event to resubmit it
+            if evaluation_result.is_valid:
+                self.conversation_state.clear_last_result()
+            elif evaluation_result.cacheable:
+                self.conversation_state.record_result(response_hash, event_index, result)
+            return result
         else:
             # Move to next event for non-student response events
             self.conversation_state.advance_to_next_event()
@@ -351,6 +793,7 @@ class LLMPrompter:
 # Example usage and testing
 if __name__ == "__main__":
     # Example usage
+    logging.basicConfig(level=logging.INFO)
     from conversation_state import ConversationState
     
     # Create conversation state and prompter
@@ -0,0 +1,14 @@
+import orjson
+from conversation_state import SCENARIO_BUNDLE_PATH, read_scenario_files
+
+
+def main():
+    """Pack scenarios/*.json into a single bundle so Lambda cold starts read one file"""
+    scenarios = read_scenario_files()
+    with open(SCENARIO_BUNDLE_PATH, 'wb') as file:
+        file.write(orjson.dumps(scenarios))
+    print(f"Packed {len(scenarios)} scenarios into {SCENARIO_BUNDLE_PATH}")
+
+
+if __name__ == '__main__':
+    main()
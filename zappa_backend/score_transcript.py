@@ -0,0 +1,41 @@
+import argparse
+import os
+import orjson
+from conversation_state import ConversationState
+from llm_prompter import LLMPrompter
+
+
+def main():
+    """Score a recorded transcript against a scenario without touching any session"""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('scenario', help="Scenario name, e.g. 'friend'")
+    parser.add_argument('transcript', help='JSON file with a list of {"event_index": ..., "student_response": ...}')
+    args = parser.parse_args()
+
+    with open(args.transcript, 'rb') as file:
+        turns = orjson.loads(file.read())
+
+    state = ConversationState()
+    prompter = LLMPrompter(
+        state,
+        aws_region=os.environ.get('AWS_REGION', 'us-east-1'),
+        model_id=os.environ.get('MODEL_ID', 'anthropic.claude-3-haiku-20240307-v1:0'),
+        latency=os.environ.get('BEDROCK_LATENCY')
+    )
+    prompter.initialize_scenario(args.scenario)
+
+    responses = [(turn['event_index'], turn['student_response']) for turn in turns]
+    for (event_index, student_response), result in zip(responses, prompter.evaluate_student_responses(responses)):
+        print(orjson.dumps({
+            'event_index': event_index,
+            'student_response': student_response,
+            'rating': result.response_type.value,
+            'is_valid': result.is_valid,
+            'explanation': result.feedback,
+            'corrected_response': result.corrected_response,
+            'extracted_variables': result.extracted_variables
+        }).decode('utf-8'))
+
+
+if __name__ == '__main__':
+    main()
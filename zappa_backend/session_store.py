@@ -0,0 +1,110 @@
+import os
+import time
+from typing import Dict, Any, Optional
+
+import orjson
+
+
+class SessionStore:
+    """Interface for where a session's conversation state is kept"""
+
+    def load(self, session) -> Optional[Dict[str, Any]]:
+        """Get the stored conversation state for this session"""
+        raise NotImplementedError
+
+    def save(self, session, state_data: Dict[str, Any]) -> None:
+        """Store the conversation state for this session"""
+        raise NotImplementedError
+
+    def clear(self, session) -> None:
+        """Remove the stored conversation state for this session"""
+        raise NotImplementedError
+
+    def has_state(self, session) -> bool:
+        """Check if this session has stored conversation state"""
+        raise NotImplementedError
+
+
+class CookieSessionStore(SessionStore):
+    """Keeps conversation state inside the signed Flask session cookie"""
+
+    def load(self, session) -> Optional[Dict[str, Any]]:
+        """Get the stored conversation state for this session"""
+        return session.get('conversation_state')
+
+    def save(self, session, state_data: Dict[str, Any]) -> None:
+        """Store the conversation state for this session"""
+        session['conversation_state'] = state_data
+
+    def clear(self, session) -> None:
+        """Remove the stored conversation state for this session"""
+        session.pop('conversation_state', None)
+
+    def has_state(self, session) -> bool:
+        """Check if this session has stored conversation state"""
+        return 'conversation_state' in session
+
+
+class DynamoDBSessionStore(SessionStore):
+    """Keeps conversation state in a DynamoDB table keyed by session_id.
+
+    Only the session_id travels in the cookie; the state itself is stored as a
+    JSON string so numbers come back as ints rather than Decimals.
+    """
+
+    def __init__(self, table_name: str, aws_region: str = 'us-east-1', ttl_seconds: int = 60 * 60 * 24 * 7):
+        self.table_name = table_name
+        self.aws_region = aws_region
+        self.ttl_seconds = ttl_seconds
+        self._client = None
+
+    def _get_dynamodb_client(self):
+        """Get the DynamoDB client (created on first use)"""
+        if self._client is None:
+            import boto3
+            self._client = boto3.client('dynamodb', region_name=self.aws_region)
+        return self._client
+
+    def load(self, session) -> Optional[Dict[str, Any]]:
+        session_id = session.get('session_id')
+        if not session_id:
+            return None
+        response = self._get_dynamodb_client().get_item(
+            TableName=self.table_name,
+            Key={'session_id': {'S': session_id}},
+            ConsistentRead=True
+        )
+        item = response.get('Item')
+        if not item:
+            return None
+        return orjson.loads(item['state']['S'])
+
+    def save(self, session, state_data: Dict[str, Any]) -> None:
+        self._get_dynamodb_client().put_item(
+            TableName=self.table_name,
+            Item={
+                'session_id': {'S': session['session_id']},
+                'state': {'S': orjson.dumps(state_data).decode('utf-8')},
+                'expires_at': {'N': str(int(time.time()) + self.ttl_seconds)}
+            }
+        )
+
+    def clear(self, session) -> None:
+        session_id = session.get('session_id')
+        if session_id:
+            self._get_dynamodb_client().delete_item(
+                TableName=self.table_name,
+                Key={'session_id': {'S': session_id}}
+            )
+
+    def has_state(self, session) -> bool:
+        return self.load(session) is not None
+
+
+def create_session_store(ttl_seconds: int) -> SessionStore:
+    """Use DynamoDB when SESSION_TABLE is configured, otherwise the session cookie"""
+    table_name = os.environ.get('SESSION_TABLE')
+    if table_name:
+        region = os.environ.get('AWS_REGION', 'us-east-1')
+        return DynamoDBSessionStore(table_name, aws_region=region, ttl_seconds=ttl_seconds)
+    return CookieSessionStore()